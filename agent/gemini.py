@@ -1,20 +1,51 @@
 """
 Gemini client — the "brain" of MarkUp.
 
+Talks to the Gemini REST API directly over one pooled HTTP/2 connection.
+
 Supports key rotation: set GEMINI_API_KEY_2 and GEMINI_API_KEY_3 in .env
 to automatically rotate between keys when rate limits are hit.
+
+Prompt prefixes shared by several calls can be uploaded once with
+cache_context() and referenced via call_gemini(cached_content_name=...).
 """
 import os
-import json
+import re
+import random
 import asyncio
+import hashlib
 import logging
-import google.generativeai as genai
+import itertools
+import threading
+from typing import Iterator
+import httpx
+import orjson
+from agent.gemini_cache import (
+    CACHE_TTL as CONTEXT_CACHE_TTL,
+    cache_digest, get_cache, store_cache, lookup_cache,
+)
+from agent.llm_cache import llm_cache
 
 logger = logging.getLogger(__name__)
 
-MODEL    = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
-RETRIES  = 3
-DELAY    = 2  # seconds between retries
+MODEL       = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+RETRIES     = int(os.getenv("GEMINI_RETRIES", "10"))
+MAX_BACKOFF = 60    # seconds; cap for exponential backoff between retries
+BAD_OUTPUT_RETRIES = 3  # attempts spent on unparseable/blocked output before giving up
+CACHE_TTL   = 3600  # seconds a deterministic response stays in llm_cache
+
+API_BASE    = "https://generativelanguage.googleapis.com/v1beta"
+
+# Markdown fences Gemini sometimes wraps JSON in, tried in order:
+#   1. ```json ... ``` closing at the very end — file contents inside the
+#      JSON may contain their own ``` fences, so match the last one
+#   2. ```json ... ``` followed by prose — close at the first fence
+#   3. ```json ... with no closing fence (output truncated)
+_FENCES = (
+    re.compile(r"^```(?:json)?\s*(.*)\s*```\s*$", re.DOTALL | re.IGNORECASE),
+    re.compile(r"^```(?:json)?\s*(.*?)\s*```", re.DOTALL | re.IGNORECASE),
+    re.compile(r"^```(?:json)?\s*(.*?)\s*$", re.DOTALL | re.IGNORECASE),
+)
 
 # ── Key rotation pool ─────────────────────────────────────────────────────────
 
@@ -25,16 +56,156 @@ def _load_keys() -> list[str]:
         raise EnvironmentError("GEMINI_API_KEY is not set")
     return keys
 
-_keys: list[str] = []
-_key_index = 0
+# next() on an itertools.cycle is a single C call, so concurrent callers
+# never see the same read-modify-write; the lock only guards first load.
+_key_cycle: Iterator[str] | None = None
+_init_lock = threading.Lock()
 
 def _next_key() -> str:
-    global _keys, _key_index
-    if not _keys:
-        _keys = _load_keys()
-    key = _keys[_key_index % len(_keys)]
-    _key_index += 1
-    return key
+    global _key_cycle
+    if _key_cycle is None:
+        with _init_lock:
+            if _key_cycle is None:
+                _key_cycle = itertools.cycle(_load_keys())
+    return next(_key_cycle)
+
+
+# ── Errors ────────────────────────────────────────────────────────────────────
+
+class GeminiHTTPError(RuntimeError):
+    """Non-2xx response from the Gemini API."""
+
+    def __init__(self, status: int, body: str):
+        super().__init__(f"Gemini HTTP {status}: {body[:500]}")
+        self.status = status
+
+    @property
+    def rate_limited(self) -> bool:
+        return self.status == 429 or "RESOURCE_EXHAUSTED" in str(self)
+
+    @property
+    def retryable(self) -> bool:
+        # Bad key (400/403) or unknown model (404) won't fix themselves
+        return self.rate_limited or self.status >= 500
+
+
+class GeminiEmptyResponse(RuntimeError):
+    """Gemini answered without any text (blocked or empty candidate)."""
+
+
+class GeminiBadOutput(RuntimeError):
+    """Gemini kept returning unparseable or empty output for the same prompt."""
+
+
+# ── Response parsing ──────────────────────────────────────────────────────────
+
+def _parse_json(text: str) -> tuple[str, dict | list]:
+    """
+    Parses Gemini's JSON output, stripping a markdown fence if present.
+    Returns (json text, parsed value); raises the last JSONDecodeError.
+    """
+    bodies = [m.group(1) for m in (fence.match(text) for fence in _FENCES) if m] or [text]
+    error: orjson.JSONDecodeError | None = None
+    for body in dict.fromkeys(bodies):
+        try:
+            return body, orjson.loads(body)
+        except orjson.JSONDecodeError as e:
+            error = e
+    raise error
+
+
+# ── HTTP transport ────────────────────────────────────────────────────────────
+
+# One keep-alive HTTP/2 client for every Gemini request, so concurrent calls
+# multiplex over a warm connection instead of paying a TLS handshake each.
+# Created lazily per event loop and reset on close, so the app can be
+# started again in the same process (tests, embedded servers).
+_client: httpx.AsyncClient | None = None
+_client_loop: asyncio.AbstractEventLoop | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client, _client_loop
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            base_url=API_BASE,
+            http2=True,
+            timeout=60,
+            limits=httpx.Limits(max_keepalive_connections=20),
+        )
+        _client_loop = loop
+    return _client
+
+
+async def close_client() -> None:
+    """Closes the pooled connection — call on app shutdown."""
+    global _client, _client_loop
+    if _client is not None:
+        await _client.aclose()
+    _client, _client_loop = None, None
+
+
+def _content(text: str) -> dict:
+    return {"parts": [{"text": text}]}
+
+
+async def _post(path: str, api_key: str, body: dict) -> dict:
+    """POSTs JSON to the Gemini API; raises GeminiHTTPError on failure."""
+    response = await _get_client().post(
+        path,
+        content=orjson.dumps(body),
+        # Header, not ?key= — keeps the key out of URLs in logs and errors
+        headers={"content-type": "application/json", "x-goog-api-key": api_key},
+    )
+    if response.status_code >= 400:
+        raise GeminiHTTPError(response.status_code, response.text)
+    return orjson.loads(response.content)
+
+
+def _response_text(data: dict) -> str:
+    """Joins the text parts of the first candidate in a generateContent response."""
+    candidates = data.get("candidates") or []
+    if not candidates:
+        raise GeminiEmptyResponse(f"Gemini returned no candidates: {data.get('promptFeedback')}")
+    candidate = candidates[0]
+    texts = [part["text"] for part in candidate.get("content", {}).get("parts", []) if "text" in part]
+    if not texts:
+        # Blocked responses (SAFETY, RECITATION, ...) carry no parts — never
+        # let that become an empty patched file
+        raise GeminiEmptyResponse(f"Gemini returned no text (finishReason={candidate.get('finishReason')})")
+    return "".join(texts)
+
+
+# ── Context caching ───────────────────────────────────────────────────────────
+
+async def cache_context(system_prompt: str, shared_context: str) -> str | None:
+    """
+    Uploads system_prompt + shared_context as a Gemini context cache.
+    Returns the cache name, or None if it is too small / caching failed.
+    """
+    digest = cache_digest(MODEL, system_prompt, shared_context)
+    if digest is None:
+        return None
+
+    name = get_cache(digest)
+    if name:
+        return name
+
+    api_key = _next_key()
+    try:
+        cache = await _post("cachedContents", api_key, {
+            "model":             f"models/{MODEL}",
+            "systemInstruction": _content(system_prompt),
+            "contents":          [{"role": "user", **_content(shared_context)}],
+            "ttl":               f"{CONTEXT_CACHE_TTL}s",
+        })
+    except Exception as e:
+        logger.warning(f"Context cache unavailable: {e} — sending full prompts")
+        return None
+
+    store_cache(digest, cache["name"], api_key)
+    return cache["name"]
 
 
 # ── Main call ─────────────────────────────────────────────────────────────────
@@ -43,61 +214,106 @@ async def call_gemini(
     system_prompt: str,
     task_prompt: str,
     expect_json: bool = False,
-) -> dict | str:
+    cached_content_name: str | None = None,
+    temperature: float = 0.0,
+) -> dict | list | str:
     """
     Call Gemini with retry + key rotation.
 
-    - expect_json=True  → returns a parsed dict
+    - expect_json=True  → returns the parsed JSON (dict, or list for batches)
     - expect_json=False → returns a plain string
+    - cached_content_name → name from cache_context(); the cached system
+      prompt + context replace system_prompt for this call
+    - temperature <= 0 → deterministic, so responses are memoized in llm_cache
     """
+    cache_key = None
+    if temperature <= 0:
+        cache_key = hashlib.sha256(orjson.dumps({
+            "m": MODEL,
+            "s": system_prompt,
+            "t": task_prompt,
+            "j": expect_json,
+            "c": cached_content_name,
+        }, option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+        hit = await llm_cache.get(cache_key)
+        if hit is not None:
+            logger.info("Gemini response served from cache")
+            return orjson.loads(hit) if expect_json else hit
+
+    # Caches are scoped to the key that created them, so cached calls pin it
+    api_key = lookup_cache(cached_content_name) if cached_content_name else None
+    if cached_content_name and not api_key:
+        raise RuntimeError(f"Gemini context cache {cached_content_name} has expired")
+
+    prompt = task_prompt
+    if expect_json:
+        prompt += "\n\nReturn valid JSON only — no markdown, no explanation."
+
+    body = {
+        "contents": [{"role": "user", **_content(prompt)}],
+        "generationConfig": {
+            "temperature":     temperature,  # 0 = deterministic code + implicit cache hits
+            "maxOutputTokens": 8192,
+        },
+    }
+    if cached_content_name:
+        # The cached prefix already carries the system prompt
+        body["cachedContent"] = cached_content_name
+    else:
+        body["systemInstruction"] = _content(system_prompt)
+
     last_error: Exception | None = None
+    bad_outputs = 0
 
     for attempt in range(RETRIES):
         try:
-            genai.configure(api_key=_next_key())
-
-            model = genai.GenerativeModel(
-                model_name=MODEL,
-                system_instruction=system_prompt,
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0.2,        # low temp = more predictable code
-                    max_output_tokens=8192,
-                ),
-            )
-
-            prompt = task_prompt
-            if expect_json:
-                prompt += "\n\nReturn valid JSON only — no markdown, no explanation."
+            # Kept across retries; only rotated after a rate-limit error
+            if api_key is None:
+                api_key = _next_key()
 
             logger.info(f"Calling Gemini (attempt {attempt + 1}/{RETRIES})")
 
-            # run_in_executor keeps the async event loop unblocked
-            loop = asyncio.get_event_loop()
-            response = await loop.run_in_executor(
-                None, lambda: model.generate_content(prompt)
-            )
+            data = await _post(f"models/{MODEL}:generateContent", api_key, body)
 
-            text = response.text.strip()
+            text = _response_text(data).strip()
 
             if expect_json:
-                # Strip markdown fences if Gemini added them
-                if text.startswith("```"):
-                    text = text.split("```")[1].lstrip("json").strip()
-                return json.loads(text)
+                text, result = _parse_json(text)
+            else:
+                result = text
 
-            return text
+            if cache_key:
+                await llm_cache.set(cache_key, text, ttl=CACHE_TTL)
+            return result
 
-        except json.JSONDecodeError as e:
-            logger.warning(f"Bad JSON from Gemini: {e} — retrying")
+        except (orjson.JSONDecodeError, GeminiEmptyResponse) as e:
+            # Unusable output — worth a few retries, not the full budget
             last_error = e
+            bad_outputs += 1
+            if bad_outputs >= BAD_OUTPUT_RETRIES:
+                raise GeminiBadOutput(f"Gemini returned unusable output {bad_outputs} times: {e}") from e
+            logger.warning(f"Unusable output from Gemini: {e} — retrying")
 
-        except Exception as e:
-            if any(word in str(e).lower() for word in ("quota", "rate", "429")):
-                logger.warning(f"Rate limit — rotating key, waiting {DELAY * (attempt + 1)}s")
+        except GeminiHTTPError as e:
+            if not e.retryable:
+                raise RuntimeError(f"Gemini request rejected: {e}") from e
+            if e.rate_limited:
+                logger.warning("Rate limit — rotating key")
+                if not cached_content_name:
+                    api_key = None
             else:
                 logger.error(f"Gemini error: {e}")
             last_error = e
 
-        await asyncio.sleep(DELAY * (attempt + 1))
+        except httpx.TransportError as e:
+            logger.error(f"Gemini connection error: {e!r}")
+            last_error = e
+
+        if attempt + 1 < RETRIES:
+            # Exponential backoff + jitter so concurrent callers don't retry in lockstep
+            delay = min(MAX_BACKOFF, 2 ** attempt + random.uniform(0, 0.2 * 2 ** attempt))
+            logger.info(f"Retrying Gemini in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
-    raise RuntimeError(f"Gemini failed after {RETRIES} attempts: {last_error}")
+    raise RuntimeError(f"Gemini failed: {last_error}")
@@ -0,0 +1,62 @@
+"""
+Gemini context caching for prompt prefixes shared across several calls.
+
+The system prompt plus the run's file snippets are uploaded once as a
+CachedContent; follow-up calls reference it by name and are billed the
+discounted cached-token rate instead of resending the full prefix.
+
+This module only tracks which caches exist and when they expire — the
+REST calls that create and use them live in agent/gemini.py.
+"""
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+CACHE_TTL        = 600   # seconds a cache lives on Gemini's side
+REFRESH_MARGIN   = 60    # recreate when this close to expiry
+MIN_CACHE_TOKENS = 2048  # Gemini rejects caches smaller than this
+CHARS_PER_TOKEN  = 4     # cheap token estimate, shared with patcher batching
+
+# digest → (cache name, api key it was created with, local expiry timestamp)
+_caches: dict[str, tuple[str, str, float]] = {}
+# cache name → digest, so call_gemini can resolve a name without a network hop
+_names: dict[str, str] = {}
+
+
+def cache_digest(model: str, system_prompt: str, shared_context: str) -> str | None:
+    """SHA256 identifying a cacheable prefix, or None if it is too small to cache."""
+    if (len(system_prompt) + len(shared_context)) // CHARS_PER_TOKEN < MIN_CACHE_TOKENS:
+        return None
+    return hashlib.sha256("\0".join((model, system_prompt, shared_context)).encode()).hexdigest()
+
+
+def get_cache(digest: str) -> str | None:
+    """Returns the name of a live cache for digest, unless it is about to expire."""
+    entry = _caches.get(digest)
+    if entry and entry[2] - time.monotonic() > REFRESH_MARGIN:
+        return entry[0]
+    return None
+
+
+def store_cache(digest: str, name: str, api_key: str) -> None:
+    """Records a cache just created on Gemini's side, replacing any older one."""
+    now = time.monotonic()
+    # Drop this digest's previous cache plus anything expired, so the
+    # registry stays bounded by what is live on Gemini's side
+    for stale in [d for d, entry in _caches.items() if d == digest or entry[2] <= now]:
+        _names.pop(_caches.pop(stale)[0], None)
+
+    _caches[digest] = (name, api_key, now + CACHE_TTL)
+    _names[name] = digest
+    logger.info(f"Created context cache {name} (ttl {CACHE_TTL}s)")
+
+
+def lookup_cache(name: str) -> str | None:
+    """Returns the api key a cache name was created with, if it is still live."""
+    digest = _names.get(name)
+    entry = _caches.get(digest) if digest else None
+    if not entry or entry[2] <= time.monotonic():
+        return None
+    return entry[1]
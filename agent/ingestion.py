@@ -6,9 +6,13 @@ Key idea: Duo already identified which files and why.
 We fetch only relevant snippets — never the full repo.
 """
 import os
+import asyncio
 import logging
-from typing import Optional
-from agent.schemas import DuoPlanOutput
+import itertools
+from collections import deque
+from functools import lru_cache
+from typing import List, Optional
+from agent.schemas import DuoPlanFile, DuoPlanOutput
 
 logger = logging.getLogger(__name__)
 
@@ -26,19 +30,25 @@ BLOCKED_PREFIXES = [
     ".env", "Dockerfile", "docker-compose", "kubernetes/", "terraform/",
 ]
 
+# Lowercased once so _is_frontend can hand str.startswith a single tuple
+_BLOCKED       = tuple(b.lower() for b in BLOCKED_PREFIXES)
+_ALLOWED       = tuple(a.lower() for a in ALLOWED_PREFIXES)
+_FRONTEND_EXTS = (".tsx", ".ts", ".jsx", ".js", ".css", ".scss", ".html", ".vue", ".svelte")
+
 MAX_SNIPPET_LINES = 200  # files larger than this get trimmed
+HEAD_LINES        = 100  # lines kept from the top of a trimmed file
+TAIL_LINES        = 30   # lines kept from the bottom of a trimmed file
 
 
+@lru_cache(maxsize=4096)
 def _is_frontend(path: str) -> bool:
-    """Returns True only if the file path is safe for frontend editing."""
+    """Returns True only if the file path is safe for frontend editing (memoized)."""
     p = path.lower()
-    if any(p.startswith(b.lower()) for b in BLOCKED_PREFIXES):
+    if p.startswith(_BLOCKED):
         logger.warning(f"Blocked non-frontend file: {path}")
         return False
-    if any(p.startswith(a.lower()) for a in ALLOWED_PREFIXES):
-        return True
     # Allow common frontend extensions at the root level
-    return p.endswith((".tsx", ".ts", ".jsx", ".js", ".css", ".scss", ".html", ".vue", ".svelte"))
+    return p.startswith(_ALLOWED) or p.endswith(_FRONTEND_EXTS)
 
 
 def _read_snippet(path: str, repo_path: Optional[str], fallback: Optional[str]) -> Optional[str]:
@@ -50,17 +60,28 @@ def _read_snippet(path: str, repo_path: Optional[str], fallback: Optional[str])
     if not os.path.exists(full_path):
         return fallback
 
+    # Stream the file: never hold more than MAX_SNIPPET_LINES + 1 lines
     with open(full_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
+        head = list(itertools.islice(f, MAX_SNIPPET_LINES + 1))
+        if len(head) <= MAX_SNIPPET_LINES:
+            return "".join(head)
+
+        # Large file: keep first HEAD_LINES + last TAIL_LINES, count the rest
+        tail  = deque(head[HEAD_LINES:], maxlen=TAIL_LINES)
+        total = len(head)
+        for line in f:
+            tail.append(line)
+            total += 1
+
+    trimmed = "".join(head[:HEAD_LINES])
+    trimmed += f"\n// ... [{total - HEAD_LINES - TAIL_LINES} lines trimmed] ...\n\n"
+    trimmed += "".join(tail)
+    return trimmed
 
-    if len(lines) <= MAX_SNIPPET_LINES:
-        return "".join(lines)
 
-    # Large file: keep first 100 + last 30 lines
-    trimmed = "".join(lines[:100])
-    trimmed += f"\n// ... [{len(lines) - 130} lines trimmed] ...\n\n"
-    trimmed += "".join(lines[-30:])
-    return trimmed
+def _read_all_snippets(files: List[DuoPlanFile], repo_path: Optional[str]) -> List[Optional[str]]:
+    """Reads every snippet in one go so the whole batch costs a single thread hop."""
+    return [_read_snippet(file.path, repo_path, file.snippet) for file in files]
 
 
 async def ingest_duo_plan(duo_plan: DuoPlanOutput, slack_intent: str, repo_path: Optional[str] = None) -> dict:
@@ -70,19 +91,27 @@ async def ingest_duo_plan(duo_plan: DuoPlanOutput, slack_intent: str, repo_path:
     """
     logger.info(f"Ingesting Duo plan: '{duo_plan.issue_title}' ({len(duo_plan.files)} files)")
 
-    allowed, blocked = [], []
+    frontend, blocked = [], []
 
     for file in duo_plan.files:
         if _is_frontend(file.path):
-            allowed.append({
-                "path":        file.path,
-                "reason":      file.reason,
-                "snippet":     _read_snippet(file.path, repo_path, file.snippet),
-                "change_type": file.change_type,
-            })
+            frontend.append(file)
         else:
             blocked.append(file.path)
 
+    # File reads block, so run them off the event loop — one job for all files
+    snippets = await asyncio.to_thread(_read_all_snippets, frontend, repo_path)
+
+    allowed = [
+        {
+            "path":        file.path,
+            "reason":      file.reason,
+            "snippet":     snippet,
+            "change_type": file.change_type,
+        }
+        for file, snippet in zip(frontend, snippets)
+    ]
+
     if blocked:
         logger.warning(f"Skipped {len(blocked)} non-frontend files: {blocked}")
 
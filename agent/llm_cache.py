@@ -0,0 +1,70 @@
+"""
+Response cache for deterministic Gemini calls.
+
+Identical prompts at temperature 0 give identical answers, so repeat runs
+(dev iteration, retried Slack requests) can skip the network entirely.
+In-process LRU by default; set MARKUP_CACHE_URL=redis://... to share the
+cache across workers (needs the optional `redis` package).
+"""
+import os
+import time
+import logging
+from collections import OrderedDict
+
+try:
+    import redis.asyncio as redis
+except ImportError:  # optional dependency
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+MAX_ENTRIES = 1024
+KEY_PREFIX  = "markup:llm:"
+
+
+class LLMCache:
+    """Async get/set cache: Redis when configured, in-memory LRU otherwise."""
+
+    def __init__(self, url: str | None = None, max_entries: int = MAX_ENTRIES):
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+        self._max_entries = max_entries
+        self._redis = None
+
+        if url:
+            if redis is None:
+                logger.warning("MARKUP_CACHE_URL is set but redis is not installed — using memory cache")
+            else:
+                self._redis = redis.from_url(url, decode_responses=True)
+
+    async def get(self, key: str) -> str | None:
+        if self._redis is not None:
+            try:
+                return await self._redis.get(KEY_PREFIX + key)
+            except Exception as e:
+                logger.warning(f"Redis cache read failed: {e}")
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: str, ttl: int) -> None:
+        if self._redis is not None:
+            try:
+                await self._redis.set(KEY_PREFIX + key, value, ex=ttl)
+                return
+            except Exception as e:
+                logger.warning(f"Redis cache write failed: {e}")
+
+        self._entries[key] = (value, time.monotonic() + ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+llm_cache = LLMCache(os.getenv("MARKUP_CACHE_URL"))
@@ -7,30 +7,87 @@ runs it through Gemini to produce patches, then returns them.
 Start with:
     uvicorn agent.main:app --reload --port 8000
 """
+import os
+import asyncio
 import logging
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse
+from pydantic import ValidationError
 from agent.schemas import IngestionRequest, AgentResponse
 from agent.ingestion import ingest_duo_plan
 from agent.planner import plan_from_duo_output
 from agent.patcher import generate_patches
 from agent.validator import validate_patches
+from agent.gemini import close_client
 
 logging.basicConfig(level=logging.INFO, format="%(levelname)s  %(name)s  %(message)s")
 logger = logging.getLogger(__name__)
 
-app = FastAPI(title="MarkUp Agent", version="1.0.0")
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", "16"))
 
 
-@app.post("/ingest", response_model=AgentResponse)
-async def ingest(request: IngestionRequest):
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Sized default executor for asyncio.to_thread (snippet reads)
+    executor = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE, thread_name_prefix="markup")
+    asyncio.get_running_loop().set_default_executor(executor)
+    yield
+    await close_client()
+    executor.shutdown(wait=False)
+
+
+app = FastAPI(
+    title="MarkUp Agent",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,  # patches can be large; orjson serializes fast
+)
+
+# /ingest reads the raw body, so FastAPI can't infer its schema — declare it
+# and register IngestionRequest + its nested models as OpenAPI components
+_INGEST_SCHEMAS = IngestionRequest.model_json_schema(ref_template="#/components/schemas/{model}")
+_INGEST_SCHEMAS = {**_INGEST_SCHEMAS.pop("$defs", {}), "IngestionRequest": _INGEST_SCHEMAS}
+_default_openapi = app.openapi
+
+
+def _openapi() -> dict:
+    schema = _default_openapi()
+    schema.setdefault("components", {}).setdefault("schemas", {}).update(_INGEST_SCHEMAS)
+    return schema
+
+
+app.openapi = _openapi
+
+
+@app.post(
+    "/ingest",
+    response_model=AgentResponse,
+    openapi_extra={"requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": {"$ref": "#/components/schemas/IngestionRequest"}}},
+    }},
+)
+async def ingest(raw: Request):
     """
     Main pipeline:
       1. Parse + filter the Duo Planner output (frontend files only)
       2. Ask Gemini to produce a structured patch plan
-      3. Ask Gemini to generate the actual file patches (one call per file)
+      3. Ask Gemini to generate the actual file patches (batched per call)
       4. Validate patches against frontend-only guardrails
       5. Return patches to the TypeScript layer
     """
+    # Validate the raw body straight from JSON — skips FastAPI's dict round-trip
+    try:
+        request = IngestionRequest.model_validate_json(await raw.body())
+    except ValidationError as e:
+        # Same error shape FastAPI gives typed body params: loc starts with "body"
+        raise RequestValidationError([
+            {**error, "loc": ("body", *error["loc"])} for error in e.errors(include_url=False)
+        ]) from e
+
     logger.info(f"Run {request.run_id} — intent: '{request.slack_intent}'")
 
     try:
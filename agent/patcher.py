@@ -1,15 +1,38 @@
 """
-Patcher: calls Gemini once per file to generate the updated file content.
+Patcher: asks Gemini for the updated content of each file in the plan.
 
-One file per call = smaller prompts = fewer token failures.
+Files are grouped into batches so the system prompt and round-trip are paid
+once per batch instead of once per file. A batch that would blow the token
+budget is split; a batch of one falls back to the plain per-file prompt.
+Batches run concurrently, capped by a semaphore to stay under rate limits.
+When a run needs several calls, the system prompt and every file block are
+uploaded once as a Gemini context cache and each call just names its files.
+
+Diffs use the C++ diff-match-patch (optional `fast-diff-match-patch`) when
+installed, and pure-Python difflib otherwise.
 """
+import os
+import asyncio
 import difflib
+import hashlib
 import logging
-from agent.gemini import call_gemini
+from agent.gemini import GeminiBadOutput, call_gemini, cache_context
+from agent.gemini_cache import CHARS_PER_TOKEN
 from agent.schemas import FilePatch
 
+try:
+    from fast_diff_match_patch import diff as _dmp_diff
+except ImportError:  # optional dependency
+    _dmp_diff = None
+
 logger = logging.getLogger(__name__)
 
+BATCH_TOKEN_BUDGET = 6000  # rough input-token cap per batched call
+MAX_CONCURRENCY    = int(os.getenv("GEMINI_MAX_CONCURRENCY", "4"))
+
+# Shared across runs so concurrent /ingest requests also respect the cap
+_gemini_slots = asyncio.Semaphore(MAX_CONCURRENCY)
+
 SYSTEM_PROMPT = """
 You are a frontend code patch generator for MarkUp.
 You receive a specific change instruction and the current file content.
@@ -22,7 +45,25 @@ Rules:
 - Return the full file content
 """
 
+# Templates put their invariant instructions first and the per-file data
+# last, so consecutive calls share the longest possible prompt prefix
+# (Gemini's implicit cache discounts repeated prefixes).
+
 TASK_TEMPLATE = """
+Return the complete updated file content.
+
+File: {path}
+Target: {target}
+Change: {change}
+
+Current content:
+```
+{snippet}
+```
+"""
+
+BATCH_FILE_TEMPLATE = """
+[FILE {index}]
 File: {path}
 Target: {target}
 Change: {change}
@@ -31,52 +72,293 @@ Current content:
 ```
 {snippet}
 ```
+"""
+
+BATCH_TASK_TEMPLATE = """
+Apply each change below to its own file independently.
+Return a JSON array with one object per file, in this exact shape:
+[
+  {{"index": <n from [FILE n]>, "content": "<complete updated file content>"}}
+]
+{files}"""
 
+CACHED_CONTEXT_HEADER = """
+Files for this run. Each task names the [FILE n] blocks it applies to.
+"""
+
+CACHED_TASK_TEMPLATE = """
 Return the complete updated file content.
+
+Apply the change described in [FILE {index}] ({path}) from the context.
+"""
+
+CACHED_BATCH_TASK_TEMPLATE = """
+Apply the changes described in the files listed below from the context, each independently.
+Return a JSON array with one object per file, in this exact shape:
+[
+  {{"index": <n from [FILE n]>, "content": "<complete updated file content>"}}
+]
+
+{files}
 """
 
 
 async def generate_patches(plan: dict) -> list[FilePatch]:
     """
-    Iterates over each patch in the plan and calls Gemini once per file.
-    Returns a list of FilePatch objects ready for GitLab commit.
+    Batches the plan's patches and calls Gemini for every batch concurrently.
+    No-op items are dropped and duplicate changes reuse one Gemini call.
+    Returns a list of FilePatch objects ready for GitLab commit, in plan order.
     """
-    patches: list[FilePatch] = []
-
+    # No-op items produce no patch at all — the planner's snippet is only a
+    # fragment, so passing it through as the whole file would truncate it
+    plan_items: list[dict] = []
+    noop: list[str] = []
     for item in plan.get("patches", []):
-        path    = item["path"]
-        snippet = item.get("snippet", "")
+        if item.get("change_type") == "skip" or not (item.get("change") or "").strip():
+            noop.append(item["path"])
+        else:
+            plan_items.append(item)
+    if noop:
+        logger.info(f"Dropping {len(noop)} no-op patch(es): {noop}")
 
-        logger.info(f"Generating patch for: {path}")
+    # Only distinct changes go to Gemini (duplicates are keyed on path too,
+    # since output depends on it); source maps each plan item to its entry
+    # in `items`
+    items: list[dict] = []
+    source: list[int] = []
+    seen: dict[str, int] = {}
+    for item in plan_items:
+        key = hashlib.sha256("\0".join((
+            item["path"],
+            item.get("target") or "",
+            item.get("change") or "",
+            item.get("snippet") or "",
+        )).encode()).hexdigest()
+        if key not in seen:
+            seen[key] = len(items)
+            items.append(item)
+        source.append(seen[key])
 
-        task_prompt = TASK_TEMPLATE.format(
-            path=path,
-            target=item.get("target", ""),
-            change=item.get("change", ""),
-            snippet=snippet or "File content not available — apply minimal change",
-        )
+    duplicates = len(plan_items) - len(items)
+    if duplicates:
+        logger.info(f"Skipping Gemini for {duplicates} duplicate patch(es)")
 
-        patched = await call_gemini(SYSTEM_PROMPT, task_prompt, expect_json=False)
-        diff    = _diff(snippet, patched, path)
+    blocks  = [BATCH_FILE_TEMPLATE.format(index=i, **_fields(item)) for i, item in enumerate(items)]
+    batches = _chunk(blocks)
 
-        patches.append(FilePatch(
-            path=path,
-            original_content=snippet,
-            patched_content=patched,
-            diff=diff,
-            change_type=item.get("change_type", "modify"),
-        ))
+    # Only worth caching when more than one call shares the prefix
+    cache_name = None
+    if len(batches) > 1:
+        cache_name = await cache_context(SYSTEM_PROMPT, CACHED_CONTEXT_HEADER + "".join(blocks))
+
+    results = await asyncio.gather(
+        *[_patch_chunk(batch, items, blocks, cache_name) for batch in batches],
+        return_exceptions=True,
+    )
+
+    generated: list[FilePatch] = []
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+        generated.extend(result)
+
+    patches: list[FilePatch] = []
+    for item, index in zip(plan_items, source):
+        if items[index] is item:
+            patches.append(generated[index])
+        else:
+            patches.append(_build_patch(item, generated[index].patched_content))
 
     logger.info(f"Generated {len(patches)} patch(es)")
     return patches
 
 
+async def _patch_chunk(
+    batch: list[int],
+    items: list[dict],
+    blocks: list[str],
+    cache_name: str | None,
+) -> list[FilePatch]:
+    """Generates one batch and builds its FilePatch objects (diff included)."""
+    if len(batch) == 1:
+        contents = [await _patch_one(batch[0], items[batch[0]], cache_name)]
+    else:
+        try:
+            contents = await _patch_batch(batch, items, blocks, cache_name)
+        except GeminiBadOutput as e:
+            # e.g. JSON cut off at maxOutputTokens — smaller per-file calls fit.
+            # Rate limits / rejected requests propagate: more calls won't help
+            logger.warning(f"Batched call failed ({e}) — falling back to one call per file")
+            contents = list(await asyncio.gather(
+                *[_patch_one(index, items[index], cache_name) for index in batch]
+            ))
+
+    return [_build_patch(items[index], patched) for index, patched in zip(batch, contents)]
+
+
+def _build_patch(item: dict, patched: str) -> FilePatch:
+    """Wraps patched content for a plan item into a FilePatch with its diff."""
+    path    = item["path"]
+    snippet = item.get("snippet", "")
+    return FilePatch(
+        path=path,
+        original_content=snippet,
+        patched_content=patched,
+        diff=_diff(snippet or "", patched, path),
+        change_type=item.get("change_type", "modify"),
+    )
+
+
+async def _call_gemini(
+    task_prompt: str,
+    expect_json: bool,
+    cache_name: str | None,
+) -> dict | list | str:
+    """call_gemini behind the shared concurrency cap."""
+    async with _gemini_slots:
+        return await call_gemini(
+            SYSTEM_PROMPT, task_prompt,
+            expect_json=expect_json,
+            cached_content_name=cache_name,
+        )
+
+
+def _fields(item: dict) -> dict:
+    """Prompt fields shared by the single-file and batched templates."""
+    return {
+        "path":    item["path"],
+        "target":  item.get("target", ""),
+        "change":  item.get("change", ""),
+        "snippet": item.get("snippet", "") or "File content not available — apply minimal change",
+    }
+
+
+def _chunk(blocks: list[str]) -> list[list[int]]:
+    """Splits the plan's file blocks into index batches that each fit BATCH_TOKEN_BUDGET."""
+    batches: list[list[int]] = []
+    current: list[int] = []
+    used = 0
+
+    for index, block in enumerate(blocks):
+        cost = len(block) // CHARS_PER_TOKEN
+        if current and used + cost > BATCH_TOKEN_BUDGET:
+            batches.append(current)
+            current, used = [], 0
+        current.append(index)
+        used += cost
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+async def _patch_one(index: int, item: dict, cache_name: str | None) -> str:
+    """Per-file path: one plain-text Gemini call for a single file."""
+    logger.info(f"Generating patch for: {item['path']}")
+    if cache_name:
+        task_prompt = CACHED_TASK_TEMPLATE.format(index=index, path=item["path"])
+    else:
+        task_prompt = TASK_TEMPLATE.format(**_fields(item))
+    return await _call_gemini(task_prompt, expect_json=False, cache_name=cache_name)
+
+
+async def _patch_batch(
+    batch: list[int],
+    items: list[dict],
+    blocks: list[str],
+    cache_name: str | None,
+) -> list[str]:
+    """Batched path: one JSON Gemini call for several files, split back by index."""
+    logger.info(f"Generating batched patches for: {[items[i]['path'] for i in batch]}")
+    if cache_name:
+        task_prompt = CACHED_BATCH_TASK_TEMPLATE.format(
+            files="\n".join(f"- [FILE {i}] {items[i]['path']}" for i in batch),
+        )
+    else:
+        task_prompt = BATCH_TASK_TEMPLATE.format(files="".join(blocks[i] for i in batch))
+
+    result = await _call_gemini(task_prompt, expect_json=True, cache_name=cache_name)
+    by_index = {
+        entry["index"]: entry["content"]
+        for entry in (result if isinstance(result, list) else [])
+        if isinstance(entry, dict)
+        and isinstance(entry.get("index"), int)
+        and isinstance(entry.get("content"), str)
+    }
+
+    # Anything Gemini dropped from the batch gets retried on the per-file path,
+    # concurrently like the rest of the run
+    missing = [index for index in batch if index not in by_index]
+    if missing:
+        logger.warning(f"Batch response missing {[items[i]['path'] for i in missing]} — retrying alone")
+        retried = await asyncio.gather(*[_patch_one(i, items[i], cache_name) for i in missing])
+        by_index.update(zip(missing, retried))
+
+    return [by_index[index] for index in batch]
+
+
 def _diff(original: str, patched: str, path: str) -> str:
     """Produces a unified diff string for display in Slack."""
-    return "".join(difflib.unified_diff(
-        original.splitlines(keepends=True),
-        patched.splitlines(keepends=True),
-        fromfile=f"a/{path}",
-        tofile=f"b/{path}",
-        lineterm="",
-    ))
+    a = original.splitlines(keepends=True)
+    b = patched.splitlines(keepends=True)
+
+    if _dmp_diff is None:
+        return "".join(difflib.unified_diff(
+            a, b,
+            fromfile=f"a/{path}",
+            tofile=f"b/{path}",
+            lineterm="",
+        ))
+
+    out = []
+    for group in _PrecomputedMatcher(a, b, _line_opcodes(a, b)).get_grouped_opcodes(3):
+        if not out:
+            out += [f"--- a/{path}", f"+++ b/{path}"]
+        first, last = group[0], group[-1]
+        out.append(f"@@ -{_range(first[1], last[2])} +{_range(first[3], last[4])} @@")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                out += [" " + line for line in a[i1:i2]]
+                continue
+            out += ["-" + line for line in a[i1:i2]]
+            out += ["+" + line for line in b[j1:j2]]
+    return "".join(out)
+
+
+class _PrecomputedMatcher(difflib.SequenceMatcher):
+    """SequenceMatcher that reuses opcodes computed elsewhere, for get_grouped_opcodes."""
+
+    def __init__(self, a: list[str], b: list[str], opcodes: list[tuple]):
+        super().__init__(None, a, b)
+        self.opcodes = opcodes
+
+
+def _line_opcodes(a: list[str], b: list[str]) -> list[tuple]:
+    """Line-level diff in C: map each distinct line to one char, diff the strings."""
+    codes: dict[str, str] = {}
+
+    def encode(lines: list[str]) -> str:
+        return "".join(codes.setdefault(line, chr(len(codes) + 0x10000)) for line in lines)
+
+    opcodes, i, j = [], 0, 0
+    for op, n in _dmp_diff(encode(a), encode(b), checklines=False, cleanup="No", counts_only=True):
+        if op == "=":
+            opcodes.append(("equal", i, i + n, j, j + n))
+            i, j = i + n, j + n
+        elif op == "-":
+            opcodes.append(("delete", i, i + n, j, j))
+            i += n
+        else:
+            opcodes.append(("insert", i, i, j, j + n))
+            j += n
+    return opcodes
+
+
+def _range(start: int, stop: int) -> str:
+    """Unified-diff hunk range, formatted the way difflib does."""
+    beginning, length = start + 1, stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
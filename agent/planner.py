@@ -4,6 +4,7 @@ list of exactly what to change in each file.
 
 Token strategy: we send a summary/snippet per file, not the whole file.
 """
+import io
 import logging
 from agent.gemini import call_gemini
 
@@ -20,15 +21,9 @@ Rules:
 - Output valid JSON only
 """
 
+# Invariant output spec first, request-specific data last, so every plan
+# call shares the same prompt prefix (Gemini's implicit cache)
 TASK_TEMPLATE = """
-Slack request: {slack_intent}
-
-Duo issue: {issue_title}
-Description: {issue_description}
-
-Files to change:
-{files_summary}
-
 Return JSON in this exact shape:
 {{
   "summary": "one sentence describing the overall change",
@@ -42,6 +37,14 @@ Return JSON in this exact shape:
     }}
   ]
 }}
+
+Slack request: {slack_intent}
+
+Duo issue: {issue_title}
+Description: {issue_description}
+
+Files to change:
+{files_summary}
 """
 
 
@@ -50,10 +53,19 @@ async def plan_from_duo_output(ingested: dict) -> dict:
     Calls Gemini once to produce a structured patch plan from the ingested Duo output.
     """
     # Build a lean summary — snippet truncated to 300 chars per file
-    files_summary = "\n".join(
-        f"- {f['path']}: {f['reason']}\n  snippet: {(f['snippet'] or '')[:300]}"
-        for f in ingested["files"]
-    )
+    buf = io.StringIO()
+    for f in ingested["files"]:
+        snippet = f["snippet"]
+        if buf.tell():
+            buf.write("\n")
+        buf.write("- ")
+        buf.write(f["path"])
+        buf.write(": ")
+        buf.write(f["reason"])
+        buf.write("\n  snippet: ")
+        if snippet:
+            buf.write(snippet[:300])
+    files_summary = buf.getvalue()
 
     task_prompt = TASK_TEMPLATE.format(
         slack_intent=ingested["slack_intent"],
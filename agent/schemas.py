@@ -1,10 +1,18 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 from typing import List, Optional
 
+# Immutable, tolerant of extra fields from the TypeScript layer. Whitespace
+# stripping is only enabled on models without file content — snippets and
+# patched files must round-trip byte for byte.
+_CONFIG          = ConfigDict(extra="ignore", frozen=True)
+_STRIPPED_CONFIG = ConfigDict(extra="ignore", frozen=True, str_strip_whitespace=True)
+
 
 # ── What GitLab Duo Planner tells us about a single file ──────────────────────
 
 class DuoPlanFile(BaseModel):
+    model_config = _CONFIG
+
     path: str                       # e.g. "src/components/Button.tsx"
     reason: str                     # why Duo thinks this file needs changing
     snippet: Optional[str] = None   # relevant lines Duo extracted
@@ -14,6 +22,8 @@ class DuoPlanFile(BaseModel):
 # ── The full structured output from GitLab Duo Planner ────────────────────────
 
 class DuoPlanOutput(BaseModel):
+    model_config = _STRIPPED_CONFIG
+
     issue_title: str
     issue_description: str
     files: List[DuoPlanFile]
@@ -23,6 +33,8 @@ class DuoPlanOutput(BaseModel):
 # ── What the TypeScript layer sends to /ingest ────────────────────────────────
 
 class IngestionRequest(BaseModel):
+    model_config = _STRIPPED_CONFIG
+
     run_id: str
     slack_intent: str           # original plain-English message from Slack
     duo_plan_output: DuoPlanOutput
@@ -32,6 +44,8 @@ class IngestionRequest(BaseModel):
 # ── A single file patch ready for GitLab commit ───────────────────────────────
 
 class FilePatch(BaseModel):
+    model_config = _CONFIG
+
     path: str
     original_content: Optional[str] = None
     patched_content: str
@@ -42,6 +56,8 @@ class FilePatch(BaseModel):
 # ── What the agent returns to the TypeScript layer ────────────────────────────
 
 class AgentResponse(BaseModel):
+    model_config = _CONFIG
+
     run_id: str
     patches: List[FilePatch]
     summary: str
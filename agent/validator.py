@@ -1,11 +1,21 @@
 """
 Validator: final guardrail before patches are sent to GitLab.
 Raises ValueError if any patch touches non-frontend files or contains dangerous code.
+
+Dangerous-code scanning uses Hyperscan when the optional `hyperscan`
+package is installed, and a fused Python regex otherwise.
 """
 import re
+import hashlib
 import logging
+from collections import OrderedDict
 from agent.schemas import FilePatch
 
+try:
+    import hyperscan
+except ImportError:  # optional dependency
+    hyperscan = None
+
 logger = logging.getLogger(__name__)
 
 # Code patterns that should never appear in a frontend patch
@@ -20,11 +30,62 @@ DANGEROUS_PATTERNS = [
 ]
 
 # File types that must never be patched
-BLOCKED_EXTENSIONS = [
+BLOCKED_EXTENSIONS = (
     ".env", ".yml", ".yaml", ".sql", ".sh",
     ".py", ".rb", ".go", ".java",
-    "Dockerfile", "docker-compose",
-]
+)
+
+# File/dir names (matched as a prefix of any path segment) that must never be
+# patched — ".env" covers .env.local, .env.production, etc.
+BLOCKED_NAMES = (".env", "Dockerfile", "docker-compose")
+
+# Digests of content that already passed the dangerous-code scan, so retried
+# runs don't rescan identical patches. LRU-capped; values are unused.
+MAX_VALIDATED = 1024
+_validated: OrderedDict[str, None] = OrderedDict()
+
+# All dangerous patterns fused into one alternation so each patch is scanned
+# once; group g{i} tells us which entry of DANGEROUS_PATTERNS matched.
+_DANGEROUS_RE = re.compile(
+    "|".join(f"(?P<g{i}>{pattern})" for i, (pattern, _) in enumerate(DANGEROUS_PATTERNS)),
+    re.IGNORECASE,
+)
+_DESCRIPTIONS = [description for _, description in DANGEROUS_PATTERNS]
+
+
+def _compile_hyperscan():
+    """Compiles DANGEROUS_PATTERNS into one Hyperscan DFA, or None if unavailable."""
+    if hyperscan is None:
+        return None
+    try:
+        db = hyperscan.Database()
+        db.compile(
+            expressions=[pattern.encode() for pattern, _ in DANGEROUS_PATTERNS],
+            ids=list(range(len(DANGEROUS_PATTERNS))),
+            elements=len(DANGEROUS_PATTERNS),
+            flags=[hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_SINGLEMATCH] * len(DANGEROUS_PATTERNS),
+        )
+        return db
+    except Exception as e:
+        logger.warning(f"Hyperscan compile failed: {e} — using regex scan")
+        return None
+
+
+_HS_DB = _compile_hyperscan()
+
+
+def _find_dangerous(content: str) -> str | None:
+    """Returns the description of the earliest dangerous pattern in content, if any."""
+    if _HS_DB is not None:
+        matches: list[tuple[int, int]] = []
+        _HS_DB.scan(
+            content.encode("utf-8"),
+            match_event_handler=lambda pattern_id, start, end, flags, context: matches.append((end, pattern_id)),
+        )
+        return _DESCRIPTIONS[min(matches)[1]] if matches else None
+
+    match = _DANGEROUS_RE.search(content)
+    return _DESCRIPTIONS[int(match.lastgroup[1:])] if match else None
 
 
 def validate_patches(patches: list[FilePatch]) -> list[FilePatch]:
@@ -33,15 +94,22 @@ def validate_patches(patches: list[FilePatch]) -> list[FilePatch]:
     or raises ValueError describing the first violation.
     """
     for patch in patches:
-        # Check file extension
-        for ext in BLOCKED_EXTENSIONS:
-            if patch.path.endswith(ext) or ext in patch.path:
-                raise ValueError(f"Blocked: patch targets non-frontend file '{patch.path}'")
-
-        # Check for dangerous code
-        for pattern, description in DANGEROUS_PATTERNS:
-            if re.search(pattern, patch.patched_content, re.IGNORECASE):
+        # Check file type by suffix, and every path segment by name prefix
+        segments = patch.path.replace("\\", "/").split("/")
+        if patch.path.endswith(BLOCKED_EXTENSIONS) or any(seg.startswith(BLOCKED_NAMES) for seg in segments):
+            raise ValueError(f"Blocked: patch targets non-frontend file '{patch.path}'")
+
+        # Check for dangerous code — single pass, skipped for content already cleared
+        digest = hashlib.blake2b(patch.patched_content.encode(), digest_size=16).hexdigest()
+        if digest in _validated:
+            _validated.move_to_end(digest)
+        else:
+            description = _find_dangerous(patch.patched_content)
+            if description:
                 raise ValueError(f"Blocked: dangerous pattern ({description}) in '{patch.path}'")
+            _validated[digest] = None
+            if len(_validated) > MAX_VALIDATED:
+                _validated.popitem(last=False)
 
         logger.info(f"Validated: {patch.path}")
 